@@ -1,99 +1,167 @@
-import requests
-import gzip
+import aiohttp
+import asyncio
+from isal import igzip as gzip, igzip_threaded
 from io import BytesIO
-import xml.etree.ElementTree as ET
+from lxml import etree as ET
 from datetime import datetime, timedelta
-import time
+import hashlib
+import json
 import os
+import re
 import traceback
 
-def fetch_epg(url, max_retries=5):
-    headers = {
-        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36',
-        'Accept-Encoding': 'gzip, deflate',
-        'Connection': 'keep-alive'
-    }
+HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36',
+    'Accept-Encoding': 'gzip, deflate'
+}
+
+# Decompressed feeds + their ETag/Last-Modified, for conditional GETs
+CACHE_DIR = os.path.expanduser('~/.cache/epg')
+
+def cache_paths(url):
+    key = hashlib.sha1(url.encode('utf-8')).hexdigest()
+    return os.path.join(CACHE_DIR, key + '.xml'), os.path.join(CACHE_DIR, key + '.json')
+
+def load_cache_headers(url):
+    xml_path, meta_path = cache_paths(url)
+    if not os.path.exists(xml_path):
+        return {}
+    try:
+        with open(meta_path) as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    headers = {}
+    if meta.get('etag'):
+        headers['If-None-Match'] = meta['etag']
+    if meta.get('lastmod'):
+        headers['If-Modified-Since'] = meta['lastmod']
+    return headers
+
+def save_cache(url, xml_bytes, etag, lastmod):
+    if not etag and not lastmod:
+        return
+    xml_path, meta_path = cache_paths(url)
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        with open(xml_path + '.tmp', 'wb') as f:
+            f.write(xml_bytes)
+        os.replace(xml_path + '.tmp', xml_path)
+        with open(meta_path, 'w') as f:
+            json.dump({'etag': etag, 'lastmod': lastmod}, f)
+    except OSError as e:
+        print(f"[!] Could not update cache: {e}")
+
+async def fetch_epg(session, url, max_retries=5):
+    if not url:
+        return None
+    cache_headers = load_cache_headers(url)
     for attempt in range(max_retries):
         try:
-            r = requests.get(url, headers=headers, timeout=90)
-            r.raise_for_status()
-            content = r.content
-
-            try:
-                xml_str = gzip.decompress(content).decode('utf-8')
-                print(f"[+] Decompressed → {len(xml_str):,} chars")
-                return xml_str
-            except:
-                xml_str = content.decode('utf-8')
-                print(f"[+] Plain XML → {len(xml_str):,} chars")
-                return xml_str
+            async with session.get(url, headers=cache_headers) as r:
+                if r.status == 304:
+                    with open(cache_paths(url)[0], 'rb') as f:
+                        xml_bytes = f.read()
+                    print(f"[+] Not modified → {len(xml_bytes):,} bytes from cache")
+                    return xml_bytes
+                r.raise_for_status()
+                content = await r.read()
+                etag = r.headers.get('ETag')
+                lastmod = r.headers.get('Last-Modified')
+
+            # HTTP-level gzip (Content-Encoding) is already undone by aiohttp;
+            # only decompress when the payload itself is a .gz file
+            if content[:2] == b'\x1f\x8b':
+                xml_bytes = gzip.decompress(content)
+                print(f"[+] Decompressed → {len(xml_bytes):,} bytes")
+            else:
+                xml_bytes = content
+                print(f"[+] Plain XML → {len(xml_bytes):,} bytes")
+            save_cache(url, xml_bytes, etag, lastmod)
+            return xml_bytes
         except Exception as e:
             print(f"[!] Attempt {attempt+1}/{max_retries} failed: {e}")
             if attempt < max_retries - 1:
-                time.sleep(3 * (attempt + 1))
+                await asyncio.sleep(3 * (attempt + 1))
     print(f"[X] Failed to fetch {url}")
     return None
 
-def parse_epg(xml_str):
-    if not xml_str or len(xml_str) < 1000:
+async def fetch_all(*urls):
+    # One shared, pooled keep-alive session; all sources download concurrently
+    # and sources on the same host (epg.pw) reuse an open connection on retry
+    connector = aiohttp.TCPConnector(limit=4, limit_per_host=4, ttl_dns_cache=300)
+    async with aiohttp.ClientSession(headers=HEADERS, connector=connector,
+                                     timeout=aiohttp.ClientTimeout(total=90)) as session:
+        return await asyncio.gather(*(fetch_epg(session, url) for url in urls))
+
+def compile_substrings(words):
+    # One case-insensitive regex scan (run in C) replaces any() over every word
+    if not words:
+        return None
+    return re.compile('|'.join(re.escape(w) for w in words), re.IGNORECASE)
+
+def extract_channels_and_programmes(xml_bytes, keywords=None, channel_ids=None, reject_substrings=None):
+    if not xml_bytes or len(xml_bytes) < 1000:
         raise ValueError("Empty or invalid XML")
-    return ET.fromstring(xml_str)
 
-def extract_channels_and_programmes(root, keywords=None, channel_ids=None):
     channels = {}
     programmes = []
+    rejected = 0
+    keyword_re = compile_substrings(keywords)
+    reject_re = compile_substrings(reject_substrings)
+    # XMLTV start stamps (YYYYMMDDHHMMSS) sort lexicographically, so the
+    # window check is a plain string compare instead of strptime per programme
+    now = datetime.now()
+    window_start = (now - timedelta(days=1)).strftime('%Y%m%d%H%M%S')
+    window_end = (now + timedelta(days=8)).strftime('%Y%m%d%H%M%S')
 
-    # Channels - exact ID match if channel_ids provided
-    for channel in root.findall('.//channel'):
-        ch_id = channel.attrib.get('id')
-        if not ch_id:
-            continue
+    # Stream-parse: only <channel>/<programme> end events reach Python (the
+    # tag filter runs inside libxml2), and processed siblings are dropped from
+    # <tv> so the full document is never held in memory at once
+    context = ET.iterparse(BytesIO(xml_bytes), events=('end',),
+                           tag=('channel', 'programme'), huge_tree=True)
+    for _, elem in context:
+        keep = False
 
-        if channel_ids:
-            if ch_id not in channel_ids:
-                continue
-        elif keywords:
-            display_names = [dn.text.lower() for dn in channel.findall('display-name') if dn.text]
-            if not any(any(kw in name for kw in keywords) for name in display_names):
-                continue
+        if elem.tag == 'channel':
+            # Channels - exact ID match if channel_ids provided
+            ch_id = elem.get('id')
+            if not ch_id:
+                pass
+            elif channel_ids:
+                keep = ch_id in channel_ids
+            else:
+                # All display names joined once; newline-separated so a
+                # multi-word keyword can't match across two names
+                names = '\n'.join(dn.text for dn in elem.iterchildren('display-name') if dn.text)
+                keep = keyword_re is None or keyword_re.search(names) is not None
+                # Exclusions applied before any programme is matched
+                if keep and reject_re is not None and reject_re.search(names):
+                    keep = False
+                    rejected += 1
+            if keep:
+                # Note: if duplicate IDs exist in source, last one wins
+                channels[ch_id] = elem
 
-        # Keep the channel (note: if duplicate IDs exist in source, last one wins)
-        channels[ch_id] = channel
+        else:
+            # Programmes (next 8 days only) - XMLTV lists channels first
+            ch_id = elem.get('channel')
+            if ch_id in channels:
+                start_str = elem.get('start', '')[:14]
+                keep = len(start_str) < 14 or window_start <= start_str <= window_end
+                if keep:
+                    programmes.append(elem)
 
-    # Programmes (next 8 days only)
-    now = datetime.now()
-    cutoff = now + timedelta(days=8)
-    for prog in root.findall('.//programme'):
-        ch_id = prog.attrib.get('channel')
-        if ch_id in channels:
-            start_str = prog.attrib.get('start', '')
-            if len(start_str) >= 14:
-                try:
-                    start_dt = datetime.strptime(start_str[:14], '%Y%m%d%H%M%S')
-                    if start_dt < now - timedelta(days=1):
-                        continue
-                    if start_dt > cutoff:
-                        continue
-                except:
-                    pass
-            programmes.append(prog)
+        # Kept elements stay referenced from channels/programmes
+        if not keep:
+            elem.clear()
+        while elem.getprevious() is not None:
+            del elem.getparent()[0]
 
+    if rejected:
+        print(f"    → Removed {rejected} excluded channels")
     return channels, programmes
 
-def filter_out_regional(channels_dict):
-    exclude = ['tamil', 'telugu', 'malayalam', 'kannada', 'punjabi', 'marathi', 'gujarati', 'oriya', 'bhojpuri', 'urdu']
-    filtered = {}
-    removed = 0
-    for ch_id, ch in channels_dict.items():
-        names = [dn.text.lower() for dn in ch.findall('display-name') if dn.text]
-        if any(bad in ' '.join(names) for bad in exclude):
-            removed += 1
-        else:
-            filtered[ch_id] = ch
-    if removed:
-        print(f"    → Removed {removed} regional language channels")
-    return filtered
-
 # ========================================
 # CONFIG
 # ========================================
@@ -108,6 +176,9 @@ CUSTOM_EPG_URL = os.getenv('CUSTOM_EPG_URL')
 UK_KEYWORDS    = ['sky', 'tnt sports', 'premier sports', 'bt sport', 'eurosport', 'itv', 'bbc']
 CUSTOM_KEYWORDS = ['fox', 'AU: Kayo 4K', 'AU: BEIN', 'AU: ESPN', 'astro']
 
+# Jio channels whose names mention these are dropped (Hindi/English only)
+REGIONAL_LANGUAGES = ['tamil', 'telugu', 'malayalam', 'kannada', 'punjabi', 'marathi', 'gujarati', 'oriya', 'bhojpuri', 'urdu']
+
 # All requested channel IDs from epg.pw IN source (unique set)
 TARGET_CHANNEL_IDS = {
     '463932',   # Sony Pix hd
@@ -136,42 +207,40 @@ all_channels = {}
 all_programmes = []
 
 try:
+    print("0. Fetching all EPG sources concurrently...")
+    uk_xml, in_xml, in_pw_xml, custom_xml = asyncio.run(
+        fetch_all(UK_EPG_URL, IN_EPG_URL, IN_EPG_PW_URL, CUSTOM_EPG_URL)
+    )
+    print("")
+
     # 1. UK Sports
-    print("1. Fetching UK EPG...")
-    uk_xml = fetch_epg(UK_EPG_URL)
+    print("1. UK EPG...")
     if uk_xml:
-        uk_root = parse_epg(uk_xml)
-        uk_ch, uk_prog = extract_channels_and_programmes(uk_root, keywords=UK_KEYWORDS)
+        uk_ch, uk_prog = extract_channels_and_programmes(uk_xml, keywords=UK_KEYWORDS)
         all_channels.update(uk_ch)
         all_programmes.extend(uk_prog)
         print(f"   → UK: {len(uk_ch)} channels | {len(uk_prog)} programmes\n")
 
     # 2. India (Jio - Hindi/English only)
-    print("2. Fetching India EPG (Jio)...")
-    in_xml = fetch_epg(IN_EPG_URL)
+    print("2. India EPG (Jio)...")
     if in_xml:
-        in_root = parse_epg(in_xml)
-        in_ch, in_prog = extract_channels_and_programmes(in_root)  # All first
-        in_ch = filter_out_regional(in_ch)
-        in_prog = [p for p in in_prog if p.attrib['channel'] in in_ch]
+        in_ch, in_prog = extract_channels_and_programmes(in_xml, reject_substrings=REGIONAL_LANGUAGES)
         all_channels.update(in_ch)
         all_programmes.extend(in_prog)
         print(f"   → India (Jio filtered): {len(in_ch)} channels | {len(in_prog)} programmes\n")
 
     # 2.5 India epg.pw - only the requested specific channels
-    print(f"2.5 Fetching India EPG (epg.pw) - {len(TARGET_CHANNEL_IDS)} targeted channels...")
-    in_pw_xml = fetch_epg(IN_EPG_PW_URL)
+    print(f"2.5 India EPG (epg.pw) - {len(TARGET_CHANNEL_IDS)} targeted channels...")
     if in_pw_xml:
-        in_pw_root = parse_epg(in_pw_xml)
         in_pw_ch, in_pw_prog = extract_channels_and_programmes(
-            in_pw_root, channel_ids=TARGET_CHANNEL_IDS
+            in_pw_xml, channel_ids=TARGET_CHANNEL_IDS
         )
         all_channels.update(in_pw_ch)
         all_programmes.extend(in_pw_prog)
         found = len(in_pw_ch)
         print(f"   → India (epg.pw): {found} matching channels | {len(in_pw_prog)} programmes")
         if found < len(TARGET_CHANNEL_IDS):
-            missing = TARGET_CHANNEL_IDS - set(in_pw_ch.keys())
+            missing = TARGET_CHANNEL_IDS - in_pw_ch.keys()
             print(f"      Missing IDs: {', '.join(sorted(missing))}")
         else:
             print("      All requested IDs found!")
@@ -181,11 +250,9 @@ try:
 
     # 3. Custom 3rd-party source (filtered)
     if CUSTOM_EPG_URL:
-        print(f"3. Fetching Custom EPG (filtered: {', '.join(CUSTOM_KEYWORDS)})...")
-        custom_xml = fetch_epg(CUSTOM_EPG_URL)
+        print(f"3. Custom EPG (filtered: {', '.join(CUSTOM_KEYWORDS)})...")
         if custom_xml:
-            custom_root = parse_epg(custom_xml)
-            cust_ch, cust_prog = extract_channels_and_programmes(custom_root, keywords=CUSTOM_KEYWORDS)
+            cust_ch, cust_prog = extract_channels_and_programmes(custom_xml, keywords=CUSTOM_KEYWORDS)
             all_channels.update(cust_ch)
             all_programmes.extend(cust_prog)
             print(f"   → Custom: {len(cust_ch)} channels | {len(cust_prog)} programmes\n")
@@ -198,27 +265,30 @@ try:
     if not all_programmes:
         raise Exception("No programmes collected from any source!")
 
-    tv = ET.Element('tv', {
+    tv_attrib = {
         'generator-info-name': 'Merged EPG (UK + IN Jio + Selective Hindi/Movies/Entertainment from epg.pw + Custom)',
         'generator-info-url': 'GitHub Actions'
-    })
-
-    for ch in all_channels.values():
-        tv.append(ch)
-    for prog in all_programmes:
-        tv.append(prog)
-
-    xml_bytes = BytesIO()
-    ET.ElementTree(tv).write(xml_bytes, encoding='utf-8', xml_declaration=True)
-    compressed = gzip.compress(xml_bytes.getvalue())
+    }
 
-    with open('epg.xml.gz', 'wb') as f:
-        f.write(compressed)
+    # Serialize incrementally straight into the gzip stream: each element is
+    # written and then cleared, so no merged <tv> tree is ever built. The
+    # threaded writer buffers 1 MiB blocks and deflates them on all cores. A
+    # low level is plenty for text XML that is regenerated every run
+    with igzip_threaded.open('epg.xml.gz', 'wb', compresslevel=1, threads=-1) as gz, \
+            ET.xmlfile(gz, encoding='utf-8') as xf:
+        xf.write_declaration()
+        with xf.element('tv', tv_attrib):
+            for ch in all_channels.values():
+                xf.write(ch)
+                ch.clear()
+            for prog in all_programmes:
+                xf.write(prog)
+                prog.clear()
 
     print(f"\n🎉 SUCCESS! epg.xml.gz generated")
     print(f"   Total Channels   : {len(all_channels)}")
     print(f"   Total Programmes : {len(all_programmes)}")
-    print(f"   File size        : {len(compressed)/1024:.1f} KB")
+    print(f"   File size        : {os.path.getsize('epg.xml.gz')/1024:.1f} KB")
 
 except Exception as e:
     print(f"\n💥 FAILED: {e}")